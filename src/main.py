@@ -10,15 +10,19 @@ User identification priority:
 
 from mcp.server.fastmcp import FastMCP, Context
 from contextlib import asynccontextmanager
-from collections.abc import AsyncIterator
-from dataclasses import dataclass
+from collections.abc import AsyncIterator, Callable, Coroutine
 from dotenv import load_dotenv
 from mem0 import Memory
+from cachetools import TTLCache
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Any
 import contextvars
 import asyncio
-import json
+import itertools
+import orjson
 import os
 import logging
+import weakref
 
 from utils import get_mem0_client
 
@@ -36,39 +40,216 @@ current_user_id: contextvars.ContextVar[str | None] = contextvars.ContextVar(
     'current_user_id', default=None
 )
 
+# Upper bound on search_memories results, to avoid accidental full-index scans
+MAX_SEARCH_LIMIT = 50
+
+# Compact JSON tool responses by default; PRETTY_JSON=1 indents them for local debugging
+_JSON_OPTION = orjson.OPT_INDENT_2 if os.getenv("PRETTY_JSON", "0") == "1" else 0
+
+# Per-user cache of search_memories responses, keyed by
+# (user_id, generation, normalized query, limit). Writes give the user a new generation,
+# which orphans older entries until they age out. Generations come from one
+# process-wide counter, so a user whose generation was evicted gets a never-used
+# value and can't match stale entries. Only touched from the event loop thread,
+# so no locking is needed around any of these.
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "4096"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+_search_cache: TTLCache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+_search_generation: TTLCache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+_generation_counter = itertools.count(1)
+
+# Caps how many blocking Mem0 calls run in worker threads at once. Defaults to 1: the
+# shared Memory client's pgvector store reuses a single psycopg2 cursor, which is not
+# thread-safe, so overlapping calls could hand one user's rows to another user's query.
+_mem0_sem = asyncio.Semaphore(int(os.getenv("MEM0_MAX_CONCURRENCY", "1")))
+
+# Queued save_memory calls are coalesced into one Mem0 add per user per batch
+SAVE_BATCH_MAX = int(os.getenv("MEM0_BATCH_MAX", "8"))
+SAVE_BATCH_MS = float(os.getenv("MEM0_BATCH_MS", "50"))
+_save_queue: asyncio.Queue[tuple[str, str, asyncio.Future]] = asyncio.Queue()
+_save_worker: asyncio.Task | None = None
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: set[asyncio.Task] = set()
+
+# Per-user locks serializing writes (adds and deletes); searches never take them.
+# Weak values let a user's lock be collected once no writer holds or waits on it.
+_user_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+async def _run_mem0(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking Mem0 client call in a worker thread without stalling the event loop."""
+    async with _mem0_sem:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def _start_background(coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
+    """Start a task that runs detached from the caller, keeping it referenced until done."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 
 def _resolve_user_id(user_id: str | None = None) -> str:
     """Resolve user_id with priority: explicit param > header context var > env default."""
-    if user_id and user_id.strip():
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if user_id:
         resolved = user_id.strip()
-        logger.debug(f"User ID from tool parameter: {resolved}")
-        return resolved
-    
+        if resolved:
+            if debug:
+                logger.debug("User ID from tool parameter: %s", resolved)
+            return resolved
+
+    # The middleware stores the header value already stripped (or None)
     ctx_user = current_user_id.get()
-    if ctx_user and ctx_user.strip():
-        resolved = ctx_user.strip()
-        logger.debug(f"User ID from HTTP header: {resolved}")
-        return resolved
-    
-    logger.debug(f"User ID falling back to default: {DEFAULT_USER_ID}")
+    if ctx_user:
+        if debug:
+            logger.debug("User ID from HTTP header: %s", ctx_user)
+        return ctx_user
+
+    if debug:
+        logger.debug("User ID falling back to default: %s", DEFAULT_USER_ID)
     return DEFAULT_USER_ID
 
 
-# Create a dataclass for our application context
-@dataclass
-class Mem0Context:
-    """Context for the Mem0 MCP server."""
-    mem0_client: Memory
+def _user_write_lock(user_id: str) -> asyncio.Lock:
+    """Return the lock that serializes memory writes for a user.
+
+    Only called from the event loop thread, so get-then-insert needs no extra locking.
+    Callers must keep the returned lock referenced (e.g. via ``async with``) while using it.
+    """
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+def _dump_memories(memories: Any) -> tuple[int, str]:
+    """Serialize a Mem0 get_all/search response to JSON and return it with its result count.
+
+    Dict responses are flattened to their memory strings in the same pass that feeds
+    orjson; older list-style responses are serialized as-is.
+    """
+    if isinstance(memories, dict) and "results" in memories:
+        results = memories["results"]
+        payload = [memory["memory"] for memory in results]
+    else:
+        results = payload = memories
+    return len(results), orjson.dumps(payload, option=_JSON_OPTION).decode()
+
+
+def _invalidate_search_cache(user_id: str) -> None:
+    """Stop serving cached search results for a user after their memories change."""
+    _search_generation[user_id] = next(_generation_counter)
+
+
+def _search_cache_generation(user_id: str) -> int:
+    """Return the user's current search cache generation, assigning a fresh one if unset."""
+    generation = _search_generation.get(user_id)
+    if generation is None:
+        generation = _search_generation[user_id] = next(_generation_counter)
+    return generation
+
+
+async def _add_memories(mem0_client: Memory, user_id: str, texts: list[str]) -> Any:
+    """Add texts for one user with a single Mem0 call under that user's write lock."""
+    messages = [{"role": "user", "content": text} for text in texts]
+    async with _user_write_lock(user_id):
+        try:
+            return await _run_mem0(mem0_client.add, messages, user_id=user_id)
+        finally:
+            # Mem0 inserts facts one by one, so even a failed add may have changed data
+            _invalidate_search_cache(user_id)
+
+
+async def _flush_saves(
+    mem0_client: Memory, user_id: str, items: list[tuple[str, asyncio.Future]]
+) -> None:
+    """Add one user's queued texts with a single Mem0 call and resolve their callers' futures."""
+    try:
+        result = await _add_memories(mem0_client, user_id, [text for text, _ in items])
+    except Exception as e:
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for _, future in items:
+        if not future.done():
+            future.set_result(result)
+
+
+async def _save_worker_loop(mem0_client: Memory) -> None:
+    """Drain queued saves in batches of up to SAVE_BATCH_MAX or SAVE_BATCH_MS, grouped by user.
+
+    Each user's flush runs as its own task, so the worker goes straight back to the
+    queue instead of waiting on slow adds. Per-user write locks keep a user's adds in order.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _save_queue.get()]
+        deadline = loop.time() + SAVE_BATCH_MS / 1000
+        while len(batch) < SAVE_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_save_queue.get(), timeout))
+            except TimeoutError:
+                break
+
+        pending: dict[str, list[tuple[str, asyncio.Future]]] = {}
+        for uid, text, future in batch:
+            pending.setdefault(uid, []).append((text, future))
+
+        for uid, items in pending.items():
+            _start_background(_flush_saves(mem0_client, uid, items))
+
+
+# Process-wide Mem0 client, set by mem0_lifespan so tools don't walk ctx.request_context
+_MEM0: Memory | None = None
+
+# Run one throwaway search in the background on the first lifespan to prime connections
+# (MEM0_WARMUP=0 disables)
+MEM0_WARMUP = os.getenv("MEM0_WARMUP", "1") == "1"
+_warmed_up = False
+
+
+def _get_mem0() -> Memory:
+    """Return the process-wide Mem0 client, failing clearly if the lifespan hasn't set it."""
+    if _MEM0 is None:
+        raise RuntimeError("Mem0 client is not initialized (server lifespan has not started)")
+    return _MEM0
+
+
+async def _warm_up(mem0_client: Memory) -> None:
+    """Prime the embedder HTTP connection, the pgvector connection and index pages.
+
+    A single search embeds the query and runs a vector lookup, so it touches all three.
+    """
+    try:
+        await _run_mem0(mem0_client.search, "warmup", user_id="__warmup__", limit=1)
+        logger.info("Mem0 warmup search completed")
+    except Exception as e:
+        logger.warning("Mem0 warmup search failed: %s", e)
 
 
 @asynccontextmanager
-async def mem0_lifespan(server: FastMCP) -> AsyncIterator[Mem0Context]:
-    """Manages the Mem0 client lifecycle."""
+async def mem0_lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """Manages the Mem0 client lifecycle.
+
+    The client and the save batching worker are process-wide and shared by every
+    session, so they are intentionally left running when a session's lifespan ends.
+    """
+    global _MEM0, _save_worker, _warmed_up
     mem0_client = get_mem0_client()
-    try:
-        yield Mem0Context(mem0_client=mem0_client)
-    finally:
-        pass
+    _MEM0 = mem0_client
+    if MEM0_WARMUP and not _warmed_up:
+        _warmed_up = True
+        _start_background(_warm_up(mem0_client))
+    if _save_worker is None or _save_worker.done():
+        _save_worker = asyncio.create_task(_save_worker_loop(mem0_client))
+    yield
 
 
 # Initialize FastMCP server
@@ -89,20 +270,28 @@ async def save_memory(ctx: Context, text: str, user_id: str = "") -> str:
     User identification is automatic via HTTP headers in multi-user environments.
 
     Args:
-        ctx: The MCP server provided context which includes the Mem0 client
+        ctx: The MCP server provided context (the Mem0 client itself is process-wide)
         text: The content to store in memory, including any relevant details and context
         user_id: Optional explicit user identifier. Leave empty to use automatic detection.
     """
+    if not text or text.isspace():
+        return "Error saving memory: text is empty."
+
     resolved_uid = _resolve_user_id(user_id)
     try:
-        mem0_client = ctx.request_context.lifespan_context.mem0_client
-        messages = [{"role": "user", "content": text}]
-        mem0_client.add(messages, user_id=resolved_uid)
-        preview = f"{text[:100]}..." if len(text) > 100 else text
-        logger.info(f"Memory saved for user '{resolved_uid}': {preview}")
-        return f"Successfully saved memory for user '{resolved_uid}': {preview}"
+        mem0_client = _get_mem0()
+        if SAVE_BATCH_MAX <= 1:
+            await _add_memories(mem0_client, resolved_uid, [text])
+        else:
+            future = asyncio.get_running_loop().create_future()
+            await _save_queue.put((resolved_uid, text, future))
+            await future
+        if logger.isEnabledFor(logging.INFO):
+            preview = text[:100] + ("..." if len(text) > 100 else "")
+            logger.info("Memory saved for user '%s': %s", resolved_uid, preview)
+        return f"Successfully saved memory for user '{resolved_uid}'"
     except Exception as e:
-        logger.error(f"Error saving memory for user '{resolved_uid}': {e}")
+        logger.error("Error saving memory for user '%s': %s", resolved_uid, e)
         return f"Error saving memory: {str(e)}"
 
 
@@ -113,25 +302,21 @@ async def get_all_memories(ctx: Context, user_id: str = "") -> str:
     Retrieves complete memory context. User identification is automatic via HTTP headers.
 
     Args:
-        ctx: The MCP server provided context which includes the Mem0 client
+        ctx: The MCP server provided context (the Mem0 client itself is process-wide)
         user_id: Optional explicit user identifier. Leave empty to use automatic detection.
 
     Returns a JSON formatted list of all stored memories.
     """
     resolved_uid = _resolve_user_id(user_id)
     try:
-        mem0_client = ctx.request_context.lifespan_context.mem0_client
-        memories = mem0_client.get_all(user_id=resolved_uid)
+        mem0_client = _get_mem0()
+        memories = await _run_mem0(mem0_client.get_all, user_id=resolved_uid)
 
-        if isinstance(memories, dict) and "results" in memories:
-            flattened_memories = [memory["memory"] for memory in memories["results"]]
-        else:
-            flattened_memories = memories
-
-        logger.info(f"Retrieved {len(flattened_memories)} memories for user '{resolved_uid}'")
-        return json.dumps(flattened_memories, indent=2)
+        count, result = _dump_memories(memories)
+        logger.info("Retrieved %d memories for user '%s'", count, resolved_uid)
+        return result
     except Exception as e:
-        logger.error(f"Error retrieving memories for user '{resolved_uid}': {e}")
+        logger.error("Error retrieving memories for user '%s': %s", resolved_uid, e)
         return f"Error retrieving memories: {str(e)}"
 
 
@@ -143,28 +328,40 @@ async def search_memories(ctx: Context, query: str, limit: int = 3, user_id: str
     User identification is automatic via HTTP headers.
 
     Args:
-        ctx: The MCP server provided context which includes the Mem0 client
+        ctx: The MCP server provided context (the Mem0 client itself is process-wide)
         query: Search query string describing what you're looking for. Can be natural language.
-        limit: Maximum number of results to return (default: 3)
+        limit: Maximum number of results to return (default: 3, max: 50)
         user_id: Optional explicit user identifier. Leave empty to use automatic detection.
     """
+    if not query or query.isspace():
+        return "Error searching memories: query is empty."
+    if limit <= 0:
+        return "Error searching memories: limit must be a positive integer."
+    limit = min(limit, MAX_SEARCH_LIMIT)
+
     resolved_uid = _resolve_user_id(user_id)
+    generation = _search_cache_generation(resolved_uid)
+    cache_key = (resolved_uid, generation, " ".join(query.lower().split()), limit)
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("Search cache hit for user '%s': '%s'", resolved_uid, query)
+        return cached
     try:
-        mem0_client = ctx.request_context.lifespan_context.mem0_client
-        memories = mem0_client.search(query, user_id=resolved_uid, limit=limit)
-
-        if isinstance(memories, dict) and "results" in memories:
-            flattened_memories = [memory["memory"] for memory in memories["results"]]
-        else:
-            flattened_memories = memories
+        mem0_client = _get_mem0()
+        memories = await _run_mem0(
+            mem0_client.search, query, user_id=resolved_uid, limit=limit
+        )
 
+        count, result = _dump_memories(memories)
         logger.info(
-            f"Search for '{query}' returned {len(flattened_memories)} results "
-            f"for user '{resolved_uid}'"
+            "Search for '%s' returned %d results for user '%s'", query, count, resolved_uid
         )
-        return json.dumps(flattened_memories, indent=2)
+        # A write that landed while Mem0 was searching makes this result stale
+        if _search_generation.get(resolved_uid) == generation:
+            _search_cache[cache_key] = result
+        return result
     except Exception as e:
-        logger.error(f"Error searching memories for user '{resolved_uid}': {e}")
+        logger.error("Error searching memories for user '%s': %s", resolved_uid, e)
         return f"Error searching memories: {str(e)}"
 
 
@@ -173,7 +370,7 @@ async def delete_all_memories(ctx: Context, confirm: bool = False, user_id: str
     """Delete all stored memories for the current user. Requires explicit confirmation.
 
     Args:
-        ctx: The MCP server provided context which includes the Mem0 client
+        ctx: The MCP server provided context (the Mem0 client itself is process-wide)
         confirm: Must be set to true to confirm deletion. Safety guard against accidental deletion.
         user_id: Optional explicit user identifier. Leave empty to use automatic detection.
     """
@@ -182,44 +379,86 @@ async def delete_all_memories(ctx: Context, confirm: bool = False, user_id: str
 
     resolved_uid = _resolve_user_id(user_id)
     try:
-        mem0_client = ctx.request_context.lifespan_context.mem0_client
-        mem0_client.delete_all(user_id=resolved_uid)
-        logger.info(f"All memories deleted for user '{resolved_uid}'")
+        mem0_client = _get_mem0()
+        async with _user_write_lock(resolved_uid):
+            try:
+                await _run_mem0(mem0_client.delete_all, user_id=resolved_uid)
+            finally:
+                # delete_all removes vectors one by one, so a failure can leave partial changes
+                _invalidate_search_cache(resolved_uid)
+        logger.info("All memories deleted for user '%s'", resolved_uid)
         return f"Successfully deleted all memories for user '{resolved_uid}'."
     except Exception as e:
-        logger.error(f"Error deleting memories for user '{resolved_uid}': {e}")
+        logger.error("Error deleting memories for user '%s': %s", resolved_uid, e)
         return f"Error deleting memories: {str(e)}"
 
 
-def _create_user_id_middleware():
-    """Create Starlette middleware class for X-User-ID header extraction."""
-    from starlette.middleware.base import BaseHTTPMiddleware
-    from starlette.requests import Request
-
-    class UserIDMiddleware(BaseHTTPMiddleware):
-        """Extract X-User-ID from request headers and set context variable.
-
-        Checks headers in priority order:
-        1. x-user-id (standard, set by LibreChat {{LIBRECHAT_USER_ID}})
-        2. x-user-email (alternative, set by LibreChat {{LIBRECHAT_USER_EMAIL}})
-        3. x-librechat-user-id (explicit LibreChat header)
-        """
-        async def dispatch(self, request: Request, call_next):
-            user_id = (
-                request.headers.get("x-user-id")
-                or request.headers.get("x-user-email")
-                or request.headers.get("x-librechat-user-id")
-            )
+# User ID headers mapped to their priority (lower wins); ASGI header names are lowercase
+_USER_ID_HEADER_PRIORITY: dict[bytes, int] = {
+    b"x-user-id": 0,
+    b"x-user-email": 1,
+    b"x-librechat-user-id": 2,
+}
+_USER_ID_HEADERS = frozenset(_USER_ID_HEADER_PRIORITY)
+
+
+class UserIDMiddleware:
+    """Pure ASGI middleware that extracts the user ID header and sets the context variable.
+
+    Checks headers in priority order:
+    1. x-user-id (standard, set by LibreChat {{LIBRECHAT_USER_ID}})
+    2. x-user-email (alternative, set by LibreChat {{LIBRECHAT_USER_EMAIL}})
+    3. x-librechat-user-id (explicit LibreChat header)
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            best = b""
+            best_rank = len(_USER_ID_HEADER_PRIORITY)
+            for name, value in scope["headers"]:
+                if name not in _USER_ID_HEADERS or not value:
+                    continue
+                rank = _USER_ID_HEADER_PRIORITY[name]
+                if rank < best_rank:
+                    best_rank, best = rank, value
+                    if rank == 0:
+                        break
+            user_id = best.decode("latin-1").strip() or None
             if user_id:
+                # Tools run in the SSE session task and the mcp Context does not expose the
+                # ASGI scope, so the context variable is the only way to hand this to them.
                 current_user_id.set(user_id)
-                logger.debug(f"Header X-User-ID set: {user_id}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Header X-User-ID set: %s", user_id)
             else:
                 logger.debug("No user ID header found in request")
 
-            response = await call_next(request)
-            return response
+        await self.app(scope, receive, send)
 
-    return UserIDMiddleware
+
+async def _serve_app(app, transport_name: str):
+    """Serve a Starlette app with uvicorn using the httptools parser."""
+    import uvicorn
+
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8050"))
+
+    logger.info(
+        "Starting MCP-Mem0 %s server on %s:%d (multi-user mode)", transport_name, host, port
+    )
+    logger.info("Default user ID: %s", DEFAULT_USER_ID)
+
+    # The event loop itself is chosen in _event_loop_factory(); Server.serve() runs on
+    # whatever loop is already running. Both asyncio and uvloop set TCP_NODELAY on
+    # accepted connections, so SSE frames are not held back by Nagle's algorithm.
+    config = uvicorn.Config(
+        app, host=host, port=port, log_level="info", http="httptools", ws="none"
+    )
+    server = uvicorn.Server(config)
+    await server.serve()
 
 
 async def run_sse_with_middleware():
@@ -229,7 +468,6 @@ async def run_sse_with_middleware():
     to the Starlette app before running. This is necessary because mcp 1.3.0
     does not expose the Starlette app object directly.
     """
-    import uvicorn
     from mcp.server.sse import SseServerTransport
     from starlette.applications import Starlette
     from starlette.routing import Mount, Route
@@ -254,17 +492,9 @@ async def run_sse_with_middleware():
         ],
     )
 
-    app.add_middleware(_create_user_id_middleware())
+    app.add_middleware(UserIDMiddleware)
 
-    host = os.getenv("HOST", "0.0.0.0")
-    port = int(os.getenv("PORT", "8050"))
-
-    logger.info(f"Starting MCP-Mem0 SSE server on {host}:{port} (multi-user mode)")
-    logger.info(f"Default user ID: {DEFAULT_USER_ID}")
-
-    config = uvicorn.Config(app, host=host, port=port, log_level="info")
-    server = uvicorn.Server(config)
-    await server.serve()
+    await _serve_app(app, "SSE")
 
 
 async def run_streamable_http_with_middleware():
@@ -282,8 +512,8 @@ async def run_streamable_http_with_middleware():
         await run_sse_with_middleware()
         return
 
-    import uvicorn
     from starlette.applications import Starlette
+    from starlette.middleware.gzip import GZipMiddleware
     from starlette.routing import Mount
 
     transport_obj = StreamableHTTPServerTransport("/messages/")
@@ -302,17 +532,11 @@ async def run_streamable_http_with_middleware():
         ],
     )
 
-    app.add_middleware(_create_user_id_middleware())
-
-    host = os.getenv("HOST", "0.0.0.0")
-    port = int(os.getenv("PORT", "8050"))
+    app.add_middleware(UserIDMiddleware)
+    # JSON responses compress well; Starlette skips text/event-stream responses
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-    logger.info(f"Starting MCP-Mem0 Streamable HTTP server on {host}:{port} (multi-user mode)")
-    logger.info(f"Default user ID: {DEFAULT_USER_ID}")
-
-    config = uvicorn.Config(app, host=host, port=port, log_level="info")
-    server = uvicorn.Server(config)
-    await server.serve()
+    await _serve_app(app, "Streamable HTTP")
 
 
 async def main():
@@ -324,9 +548,18 @@ async def main():
         await run_streamable_http_with_middleware()
     else:
         # stdio transport - no HTTP headers available, uses DEFAULT_USER_ID or tool param
-        logger.info(f"Starting MCP-Mem0 stdio server (single-user mode, user={DEFAULT_USER_ID})")
+        logger.info("Starting MCP-Mem0 stdio server (single-user mode, user=%s)", DEFAULT_USER_ID)
         await mcp.run_stdio_async()
 
 
+def _event_loop_factory():
+    """Use uvloop when it is installed (it is not available on Windows)."""
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    return uvloop.new_event_loop
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(), loop_factory=_event_loop_factory())
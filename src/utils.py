@@ -11,6 +11,7 @@ For LiteLLM proxy compatibility, set:
 from mem0 import Memory
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+import functools
 import os
 import logging
 
@@ -18,8 +19,13 @@ load_dotenv()
 logger = logging.getLogger("mcp-mem0")
 
 
+@functools.lru_cache(maxsize=1)
 def get_mem0_client() -> Memory:
-    """Create and configure the Mem0 Memory client from environment variables."""
+    """Create and configure the Mem0 Memory client from environment variables.
+
+    The client is built once per process and reused, since FastMCP enters the
+    server lifespan for every SSE/stdio session.
+    """
     
     llm_provider = os.getenv("LLM_PROVIDER", "openai")
     llm_base_url = os.getenv("LLM_BASE_URL", "https://api.openai.com/v1")
@@ -64,7 +70,7 @@ def get_mem0_client() -> Memory:
         config["llm"]["config"]["openai_base_url"] = llm_base_url
         config["embedder"]["config"]["openai_base_url"] = llm_base_url
 
-    logger.info(f"Mem0 config: provider={llm_provider}, model={llm_choice}, "
-                f"embedder={embedding_model}, base_url={llm_base_url}")
+    logger.info("Mem0 config: provider=%s, model=%s, embedder=%s, base_url=%s",
+                llm_provider, llm_choice, embedding_model, llm_base_url)
     
     return Memory.from_config(config)